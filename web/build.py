@@ -1,9 +1,12 @@
+import concurrent.futures
+import functools
 import json
-import multiprocessing
+import mmap
 import os
 import pathlib
 import re
 import sys
+import types
 import typing
 import uuid
 import urllib3  # type: ignore
@@ -25,7 +28,14 @@ IDENTIFIER_CHARACTERS = IC = r"[a-zA-Z0-9_]"
 # URL, function argument, file name, etc
 FULL_CHARACTERS = FC = r"[a-zA-Z0-9_.:@/\-]"
 
-KWARG_ARG_REGEX = rf"({IC}+\s*=\s*({FC}+|\"[^\"]*\"|'[^']*'|\|[^\|]*\|))"
+KWARG_ARG_PATTERN = rf"({IC}+\s*=\s*({FC}+|\"[^\"]*\"|'[^']*'|\|[^\|]*\|))"
+
+# Standalone version of the above with named groups, used to parse argument
+# lists in one pass. The anonymous pattern is the one spliced into larger
+# regexes, where repeated group names would collide.
+KWARG_ARG_REGEX = re.compile(
+    rf"(?P<k>{IC}+)\s*=\s*(?P<v>{FC}+|\"[^\"]*\"|'[^']*'|\|[^\|]*\|)"
+)
 
 OPEN = r"{{"
 CLOSE = r"}}"
@@ -35,7 +45,7 @@ CLOSE = r"}}"
 # k = v args with any amount of whitespace between them
 KWARG_FILE_REGEX = (
     rf"(?P<kwarg_file>{FC}+)"
-    rf"\(\s*(?P<args>({KWARG_ARG_REGEX}(,\s*|\s*(?=\))))*)\)"
+    rf"\(\s*(?P<args>({KWARG_ARG_PATTERN}(,\s*|\s*(?=\))))*)\)"
 )
 
 # different syntax for the above
@@ -44,9 +54,13 @@ KWARG_FILE_REGEX = (
 # leading capital letter.
 HTML_FILE_REGEX = (
     rf"<\s*(?P<html_file>([A-Z]|/[A-Z])[a-zA-Z0-9_]+)\s*"
-    rf"(?P<html_args>({KWARG_ARG_REGEX}(\s+|\s*(?=>)))*)\s*/?>"
+    rf"(?P<html_args>({KWARG_ARG_PATTERN}(\s+|\s*(?=>)))*)\s*/?>"
 )
 
+# Cheap test for whether a file might contain an HTML style substitution,
+# used to skip substitution entirely for plain files.
+HTML_TAG_REGEX = re.compile(r"<\s*/?[A-Z]")
+
 # function name followed by a single argument
 FUNCTION_REGEX = rf"(?P<func>{IC}+)\((?P<arg>{FC}*)\)"
 
@@ -64,13 +78,16 @@ SUBSTITUTION_REGEXES = [
 ]
 
 # Final regex matches all substitution types
-SUBSTITUTION_REGEX = (
+SUBSTITUTION_REGEX = re.compile(
     rf"{OPEN}\s*("
     + r"|".join(SUBSTITUTION_REGEXES)
     + rf")\s*{CLOSE}|{HTML_FILE_REGEX}"
 )
 
 
+# Cached; re-parsing argv per rehosted asset is pointless and this keeps the
+# value stable even if sys.argv is mutated mid-build.
+@functools.cache
 def output_directory() -> str:
     if len(sys.argv) > 1:
         output_dir = sys.argv[1]
@@ -80,15 +97,47 @@ def output_directory() -> str:
     return output_dir
 
 
+# Files bigger than this (e.g. bundled CSS/JS includes) are mmapped so the
+# kernel can demand-page them and keep them in the page cache across
+# repeated includes.
+MMAP_THRESHOLD = 64 * 1024
+
+
+# Binary read plus a single decode; text mode pays for the encoding and
+# universal-newlines state machine across the whole file.
+def _read_text(path: str) -> str:
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size > MMAP_THRESHOLD:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                return mapped.read().decode("utf-8")
+        return f.read().decode("utf-8")
+
+
+# Matching write-side helper: one encode, one binary write, rather than
+# pushing the text through the codec layer piecewise.
+def _write_text(path: str, content: str) -> None:
+    with open(path, "wb") as f:
+        f.write(content.encode("utf-8"))
+
+
+# Set once the cache directory is known to exist, so every cache read and
+# write after the first doesn't re-stat the directory and gitignore.
+_CACHE_DIR_READY = False
+
+
 def ensure_cache_dir() -> str:
+    global _CACHE_DIR_READY
+    if _CACHE_DIR_READY:
+        return INCLUDE_CACHE_DIR
+
     if not os.path.isdir(INCLUDE_CACHE_DIR):
         pathlib.Path(INCLUDE_CACHE_DIR).mkdir(parents=True, exist_ok=True)
 
     gitignore_path = os.path.join(INCLUDE_CACHE_DIR, ".gitignore")
     if not os.path.isfile(gitignore_path):
-        with open(gitignore_path, "w") as f:
-            f.write("*")
+        _write_text(gitignore_path, "*")
 
+    _CACHE_DIR_READY = True
     return INCLUDE_CACHE_DIR
 
 
@@ -96,8 +145,7 @@ def load_cached_file(filename: str) -> typing.Optional[str]:
     cached_file = os.path.join(ensure_cache_dir(), filename)
     if os.path.isfile(cached_file):
         try:
-            with open(cached_file, "r") as f:
-                return f.read()
+            return _read_text(cached_file)
         except:
             # File is corrupted or something, we'll overwrite it with a new one.
             pass
@@ -105,55 +153,121 @@ def load_cached_file(filename: str) -> typing.Optional[str]:
 
 
 def cache_file(filename: str, content: str) -> None:
-    with open(os.path.join(ensure_cache_dir(), filename), "w") as f:
-        f.write(content)
+    _write_text(os.path.join(ensure_cache_dir(), filename), content)
+
+
+# Shared across downloads so connections to the icon CDN are reused rather
+# than paying a TCP and TLS handshake per asset.
+HTTP = urllib3.PoolManager()
 
+# If httpx (with h2) is available, prefer it; HTTP/2 multiplexes many small
+# downloads like icon fetches over a single TLS connection.
+try:
+    import httpx  # type: ignore
 
-def download_resource(url: str) -> str:
-    resp = urllib3.PoolManager().request("GET", url)
+    HTTP2: typing.Optional["httpx.Client"] = httpx.Client(
+        http2=True, follow_redirects=True
+    )
+except ImportError:
+    HTTP2 = None
+
+
+# When set in the environment, cached downloads are revalidated against the
+# server with If-None-Match instead of being trusted forever; a 304 response
+# keeps the cached copy without re-downloading the body.
+REVALIDATE = "REVALIDATE_CACHE" in os.environ
+
+
+def _etag_path(filename: str) -> str:
+    return os.path.join(ensure_cache_dir(), filename + ".etag")
+
+
+def _load_etag(filename: str) -> typing.Optional[str]:
+    try:
+        return _read_text(_etag_path(filename))
+    except OSError:
+        return None
+
+
+def _store_etag(filename: str, etag: typing.Optional[str]) -> None:
+    if etag:
+        _write_text(_etag_path(filename), etag)
+
+
+# Fetch url, returning (body, etag). If an etag is supplied it is sent as
+# If-None-Match; a 304 response yields a body of None, meaning the caller's
+# cached copy is current.
+def download_resource(
+    url: str, etag: typing.Optional[str] = None
+) -> typing.Tuple[typing.Optional[str], typing.Optional[str]]:
+    headers = {"If-None-Match": etag} if etag else None
+
+    if HTTP2 is not None:
+        resp = HTTP2.get(url, headers=headers)
+        if etag and resp.status_code == 304:
+            return None, etag
+        if resp.status_code != 200:
+            print(
+                f"[ERROR] Failed to retrieve {url} status {resp.status_code}."
+            )
+            exit(os.EX_DATAERR)
+        return resp.text, resp.headers.get("etag")
+
+    resp = HTTP.request("GET", url, headers=headers)
+    if etag and resp.status == 304:
+        return None, etag
     if resp.status != 200:
         print(f"[ERROR] Failed to retrieve {url} status {resp.status}.")
         exit(os.EX_DATAERR)
-    return resp.data.decode("utf-8")
+    return resp.data.decode("utf-8"), resp.headers.get("ETag")
+
 
+# Serve a resource from the on-disk cache, downloading (or, with REVALIDATE,
+# conditionally re-downloading) it as required.
+def fetch_cached_resource(url: str, filename: str) -> str:
+    cached = load_cached_file(filename)
+    if cached is not None and not REVALIDATE:
+        return cached
 
+    etag = _load_etag(filename) if cached is not None else None
+    content, new_etag = download_resource(url, etag)
+    if content is None:
+        # 304 Not Modified; the cached copy is current.
+        if cached is None:
+            print(f"[ERROR] Unexpected 304 response for {url}.")
+            exit(os.EX_DATAERR)
+        return cached
+
+    cache_file(filename, content)
+    _store_etag(filename, new_etag)
+    return content
+
+
+# Icons are often used many times per page; serve repeats from memory
+# rather than re-reading the disk cache.
+@functools.lru_cache(maxsize=None)
 def bootstrap_icon(name: str) -> str:
     URL_FORMAT = "https://icons.getbootstrap.com/assets/icons/{}"
 
     filename = f"{name}.svg"
-    cached_file = load_cached_file(filename)
-    if cached_file:
-        return cached_file
-    svg = download_resource(URL_FORMAT.format(filename))
-    cache_file(filename, svg)
-    return svg
+    return fetch_cached_resource(URL_FORMAT.format(filename), filename)
 
 
 def filename_from_url(url: str) -> str:
-    parts = url.split("/")
-
-    try:
-        i = 1
-        while not parts[-i]:
-            i += 1
-        return parts[-i]
-    except IndexError:
+    filename = url.rstrip("/").rpartition("/")[2]
+    if not filename:
         print(f"Couldn't determine filename for {url}")
         exit(os.EX_SOFTWARE)
+    return filename
 
 
+@functools.lru_cache(maxsize=None)
 def load_url(url: str) -> str:
-    filename = filename_from_url(url)
-    cached_content = load_cached_file(filename)
-    if cached_content:
-        return cached_content
-    content = download_resource(url)
-    cache_file(filename, content)
-    return content
+    return fetch_cached_resource(url, filename_from_url(url))
 
 
 def is_url(poss: str) -> bool:
-    return poss.startswith("http://") or poss.startswith("https://")
+    return poss.startswith(("http://", "https://"))
 
 
 def load_resource(resource: str) -> str:
@@ -166,8 +280,7 @@ def load_resource(resource: str) -> str:
 def rehost(url: str) -> str:
     data = load_resource(url)
     href = filename_from_url(url)
-    with open(os.path.join(output_directory(), href), "w") as f:
-        f.write(data)
+    _write_text(os.path.join(output_directory(), href), data)
     return "/" + href
 
 
@@ -187,20 +300,20 @@ def javascript(resource: str) -> str:
         return f"<script>{load_resource(resource)}</script>"
 
 
-def constant(
-    name: str, constants: typing.Dict[str, typing.Union[str, int]] = {}
-) -> str:
+# Loaded eagerly at import so the substitution path is a plain dict lookup
+# with no load-state check.
+_CONSTANTS: typing.Dict[str, typing.Union[str, int]] = json.loads(
+    _read_text(os.path.join(WEB_DIR, "constants.json"))
+)
+
+
+def constant(name: str) -> str:
     name = name.strip()
-    if constants:
-        try:
-            return str(constants[name])
-        except KeyError:
-            print(f"Missing constant: {name}. Aborting.")
-            exit(os.EX_NOINPUT)
-    else:
-        with open(os.path.join(WEB_DIR, "constants.json"), "r") as f:
-            constants.update(json.load(f))
-        return constant(name)
+    try:
+        return str(_CONSTANTS[name])
+    except KeyError:
+        print(f"Missing constant: {name}. Aborting.")
+        exit(os.EX_NOINPUT)
 
 
 def unique_string() -> str:
@@ -210,63 +323,95 @@ def unique_string() -> str:
     return s
 
 
-def function_from_name(
-    funcs: typing.List[typing.Callable], name: str
-) -> typing.Callable:
-    return {f.__name__: f for f in funcs}[name]
-
-
-def function_substitution(func: str, arg: str) -> str:
-    functions = [
+# Functions callable from templates, e.g. {{ constant(APP_TITLE) }}.
+FUNCTIONS: typing.Dict[str, typing.Callable] = {
+    f.__name__: f
+    for f in (
         bootstrap_icon,
         stylesheet,
         javascript,
         constant,
         unique_string,
-    ]
+    )
+}
+
+
+def function_substitution(func: str, arg: str, depth: int = 0) -> str:
     args = [s.strip() for s in arg.split(",") if s]
 
     try:
-        return function_from_name(functions, func)(*args)  # type: ignore
+        return FUNCTIONS[func](*args)  # type: ignore
     except KeyError:
         try:
-            return kwarg_file_subsitution(func, arg)
+            return kwarg_file_subsitution(func, arg, depth)
         except SystemExit:
             print(f"Missing function: {func}. Aborting.")
             exit(os.EX_NOINPUT)
 
 
+BRACE_REGEX = re.compile(r"[{}]")
+
+# Identifier then a block containing no brace at all; the common case, which
+# the regex engine can capture without any brace counting.
+FLAT_BLOCK_REGEX = re.compile(rf"[^{{}}]*{OPEN}[^{{}}]*{CLOSE}")
+
+
 def read_block(start: int, html: str) -> str:
+    m = FLAT_BLOCK_REGEX.match(html, start)
+    if m:
+        return html[start : m.end()]
+
     started = False
     n_braces = 0
-    i = start
-    while i < len(html) and (n_braces or not started):
-        if html[i] == "{":
+    end = len(html)
+
+    # Only visit the braces rather than walking a character at a time.
+    for m in BRACE_REGEX.finditer(html, start):
+        if m.group() == "{":
             n_braces += 1
-        elif html[i] == "}":
+        else:
             n_braces -= 1
 
         if n_braces == 2:
             started = True
 
-        i += 1
+        if started and not n_braces:
+            end = m.end()
+            break
 
     if n_braces:
         raise ValueError("Unterminated block.")
 
-    return html[start:i]
+    return html[start:end]
+
+
+# Block identifiers come from a tiny set (PREAMBLE, IFDEF(X), ...), so the
+# compiled header patterns are cached per identifier.
+@functools.lru_cache(maxsize=256)
+def _identifier_regex(identifier: str) -> typing.Pattern[str]:
+    return re.compile(re.escape(identifier) + rf"\s*{OPEN}")
 
 
 def read_identifier_block(identifier: str, html: str) -> str:
-    m = re.search(re.escape(identifier) + rf"\s*{OPEN}", html)
+    m = _identifier_regex(identifier).search(html)
     if m:
         return read_block(m.start(), html)
     else:
         raise ValueError(f"Missing indentifier: {identifier}")
 
 
+BLOCK_OPEN_REGEX = re.compile(rf"^{ANY}{OPEN}")
+
+
 def block_contents(block: str) -> str:
-    return re.sub(rf"^{ANY}{OPEN}", "", block)[:-2]
+    return BLOCK_OPEN_REGEX.sub("", block)[:-2]
+
+
+# The same preamble is recompiled every time its include is processed;
+# cache the code objects so repeat builds just re-execute them.
+@functools.lru_cache(maxsize=64)
+def _compile_preamble(preamble: str) -> types.CodeType:
+    return compile(preamble, "<preamble>", "exec")
 
 
 # Look away. This parses a file to check for a preprocessor block preceded by
@@ -279,14 +424,21 @@ def process_preamble(html: str, kwargs: typing.Dict[str, str]) -> str:
     except ValueError:
         return html
     preamble = block_contents(block)
-    exec(preamble)
+
+    # Preambles get the module's helpers (unique_string et al.) and the
+    # kwargs dict they are expected to mutate, rather than whatever happens
+    # to be in this function's scope.
+    exec(_compile_preamble(preamble), globals(), {"kwargs": kwargs})
     return html.replace(block, "").strip()
 
 
+ELSE_REGEX = re.compile(rf"\s*ELSE\s*{OPEN}")
+
+
 def read_ifdef_block(start: int, html: str) -> typing.Tuple[str, str, str]:
     if_block = read_block(start, html)
     i = start + len(if_block)
-    if re.match(rf"\s*ELSE\s*{OPEN}", html[i:]):
+    if ELSE_REGEX.match(html, i):
         else_block = read_block(i, html)
     else:
         else_block = ""
@@ -295,35 +447,57 @@ def read_ifdef_block(start: int, html: str) -> typing.Tuple[str, str, str]:
 
 
 BLOCK_REGEX = rf"{OPEN}{ANY}{CLOSE}"
-IFDEF_REGEX = (
+IFDEF_PATTERN = (
     rf"(?P<ident>(?P<cond>IFN?DEF)\((?P<arg>[A-Z_]+)\))\s*{BLOCK_REGEX}"
 )
-IFDEF_ELSE_REGEX = IFDEF_REGEX + rf"\s*ELSE\s*{BLOCK_REGEX}"
+IFDEF_REGEX = re.compile(IFDEF_PATTERN)
+IFDEF_ELSE_REGEX = re.compile(IFDEF_PATTERN + rf"\s*ELSE\s*{BLOCK_REGEX}")
 
 
 def _process_ifdefs(
-    regex: str, html: str, kwargs: typing.Dict[str, str]
+    regex: typing.Pattern[str], html: str, kwargs: typing.Dict[str, str]
 ) -> str:
-    m = re.search(regex, html)
+    m = regex.search(html)
     while m:
-        cond = m.group("cond")
-        kwarg = m.group("arg")
-
-        if_block, else_block, full = read_ifdef_block(m.start(), html)
-
-        if (cond == "IFDEF" and kwarg in kwargs) or (
-            cond == "IFNDEF" and kwarg not in kwargs
-        ):
-            repl = block_contents(if_block).strip()
-        else:
-            repl = block_contents(else_block).strip()
-
-        html = html.replace(full, repl, 1)
-        m = re.search(regex, html)
+        # Collect the unchanged spans between ifdefs along with each block's
+        # replacement and join them once, rather than rebuilding the whole
+        # string with str.replace per block.
+        parts = []
+        pos = 0
+        rescan = False
+        while m:
+            cond = m.group("cond")
+            kwarg = m.group("arg")
+
+            if_block, else_block, full = read_ifdef_block(m.start(), html)
+
+            if (cond == "IFDEF" and kwarg in kwargs) or (
+                cond == "IFNDEF" and kwarg not in kwargs
+            ):
+                repl = block_contents(if_block).strip()
+            else:
+                repl = block_contents(else_block).strip()
+
+            if not rescan and ("IFDEF(" in repl or "IFNDEF(" in repl):
+                rescan = True
+
+            parts.append(html[pos : m.start()])
+            parts.append(repl)
+            pos = m.start() + len(full)
+            m = regex.search(html, pos)
+        parts.append(html[pos:])
+        html = "".join(parts)
+
+        # Only scan again if a replacement exposed a nested ifdef.
+        m = regex.search(html) if rescan else None
     return html
 
 
 def process_ifdefs(html: str, kwargs: typing.Dict[str, str]) -> str:
+    # Fast path: most includes have no conditional blocks at all.
+    if "IFDEF(" not in html and "IFNDEF(" not in html:
+        return html
+
     html = _process_ifdefs(IFDEF_ELSE_REGEX, html, kwargs)
     html = _process_ifdefs(IFDEF_REGEX, html, kwargs)
     return html
@@ -332,49 +506,49 @@ def process_ifdefs(html: str, kwargs: typing.Dict[str, str]) -> str:
 KWARG_REGEX = re.compile(rf"{OPEN}\s*(?P<k>[A-Z_]+)\s*{CLOSE}")
 
 
-def process_kwarg_html(html: str, kwargs: typing.Dict[str, str]) -> str:
+def process_kwarg_html(
+    html: str, kwargs: typing.Dict[str, str], depth: int = 0
+) -> str:
     html = process_preamble(html, kwargs)
     html = process_ifdefs(html, kwargs)
-    for kwarg in re.finditer(KWARG_REGEX, html):
-        html = html.replace(kwarg.group(0), kwargs.get(kwarg.group("k"), ""))
+    if OPEN in html:
+        html = KWARG_REGEX.sub(lambda m: kwargs.get(m.group("k"), ""), html)
 
-    return process_html(html)
+    return process_html(html, depth)
 
 
-QUOTE_CHARS = "\"'|"
+QUOTE_CHARS = ('"', "'", "|")
 
 
 def remove_quotes(string: str) -> str:
-    if string[0] in QUOTE_CHARS:
+    if string.startswith(QUOTE_CHARS):
         return string[1:-1]
     return string
 
 
-def kwarg_substitution(html: str, args: str = "") -> str:
+def kwarg_substitution(html: str, args: str = "", depth: int = 0) -> str:
     kwargs = {
-        k.upper(): remove_quotes(v)
-        for k, v in map(
-            lambda arg: re.split(r"\s*=\s*", arg, 1),
-            [
-                term.group(0)
-                for term in re.finditer(KWARG_ARG_REGEX, args.strip())
-            ],
-        )
+        m.group("k").upper(): remove_quotes(m.group("v"))
+        for m in KWARG_ARG_REGEX.finditer(args.strip())
     }
 
     try:
-        return process_kwarg_html(html, kwargs)
+        return process_kwarg_html(html, kwargs, depth)
     except (ValueError, KeyError) as e:
         print(f"[ERROR] Substitution failed.\nReason: {e}\nArgs: {kwargs}")
         exit(os.EX_DATAERR)
 
 
-def kwarg_file_subsitution(file: str, args: str = "") -> str:
+def kwarg_file_subsitution(file: str, args: str = "", depth: int = 0) -> str:
     html = include_file(file, False)
-    return kwarg_substitution(html, args)
+    return kwarg_substitution(html, args, depth)
+
+
+# A single camelcase word: capital letter followed by its lowercase tail.
+CAMEL_REGEX = re.compile(r"[A-Z][a-z0-9_]*")
 
 
-def html_file_substitution(tag: str, args: str = "") -> str:
+def html_file_substitution(tag: str, args: str = "", depth: int = 0) -> str:
     # </Form> means <FormEnd>
     if tag[0] == "/":
         processed = tag[1:] + "End"
@@ -383,17 +557,7 @@ def html_file_substitution(tag: str, args: str = "") -> str:
 
     # Convert from camelcase, e.g.
     # FormField to form/field or form_field
-    parts = []
-    part = ""
-    for c in processed:
-        if c.isupper():
-            if part:
-                parts.append(part)
-            part = c.lower()
-        else:
-            part += c
-    if part:
-        parts.append(part)
+    parts = [part.lower() for part in CAMEL_REGEX.findall(processed)]
 
     path = "/".join(parts)
     start = path + "/start"
@@ -409,91 +573,282 @@ def html_file_substitution(tag: str, args: str = "") -> str:
         print(f"Missing include file for tag: {tag}")
         exit(os.EX_DATAERR)
 
-    return kwarg_substitution(html, args)
+    return kwarg_substitution(html, args, depth)
+
+
+COMMENT_REGEX = re.compile(
+    r"(/\*[\s\S]*?\*/|^[ \t]*//.*|<!--[\s\S]*?-->)", re.MULTILINE
+)
 
 
 # Removes comments from text.
 # Handles C-style comments ( // and /* */ ) and HTML comments (<!-- -->)
 def strip_comments(text):
-    return re.sub(
-        r"(/\*[\s\S]*?\*/|^[ \t]*//.*|<!--[\s\S]*?-->)",
-        "",
-        text,
-        flags=re.MULTILINE,
-    )
+    return COMMENT_REGEX.sub("", text)
 
 
-def include_file(file: str, process: bool = True) -> str:
+# Reads an include file from disk, with comments stripped. Cached because
+# shared partials like the navbar are included by most pages. The processed
+# HTML is deliberately not cached; substitutions like unique_string() must
+# produce a fresh result per use.
+@functools.lru_cache(maxsize=None)
+def _read_include(file: str) -> str:
     try:
-        include = os.path.join(INCLUDE_DIR, file)
-        with open(include, "r") as f:
-            html = f.read()
+        html = _read_text(os.path.join(INCLUDE_DIR, file))
     except (FileNotFoundError, IsADirectoryError):
         # Allow omission of file extension
-        include = os.path.join(INCLUDE_DIR, file + ".html")
-        with open(include, "r") as f:
-            html = f.read()
+        html = _read_text(os.path.join(INCLUDE_DIR, file + ".html"))
+
+    return strip_comments(html)
+
 
-    html = strip_comments(html)
+def include_file(file: str, process: bool = True, depth: int = 0) -> str:
+    html = _read_include(file)
 
-    # Note: This could recurse until OOM if a file is self-referential.
-    # Don't do that.
+    # depth carries through here so a self-referential file trips the
+    # substitution depth cap rather than recursing until OOM.
     if process:
-        return process_html(html)
+        return process_html(html, depth)
     else:
         return html
 
 
-def process_html(html: str) -> str:
-    regex = re.compile(SUBSTITUTION_REGEX)
+# Bail out of substitution if it recurses this deep; almost certainly a
+# self-referential include.
+MAX_SUBSTITUTION_DEPTH = 32
 
-    m = re.search(regex, html)
-    while m:
-        groups = m.groupdict()
-        if groups.get("kwarg_file"):
-            repl = kwarg_file_subsitution(groups["kwarg_file"], groups["args"])
-        elif groups.get("html_file"):
-            repl = html_file_substitution(
-                groups["html_file"], groups["html_args"]
-            )
-        elif m.group("func"):
-            repl = function_substitution(groups["func"], groups["arg"])
-        elif groups.get("file"):
-            repl = include_file(groups["file"])
-        elif groups.get("raw"):
-            repl = groups["raw"]
+
+def handle_match(m: "re.Match[str]", depth: int = 0) -> str:
+    groups = m.groupdict()
+    if groups.get("kwarg_file"):
+        return kwarg_file_subsitution(
+            groups["kwarg_file"], groups["args"], depth
+        )
+    elif groups.get("html_file"):
+        return html_file_substitution(
+            groups["html_file"], groups["html_args"], depth
+        )
+    elif groups.get("func"):
+        return function_substitution(groups["func"], groups["arg"], depth)
+    elif groups.get("file"):
+        return include_file(groups["file"], depth=depth)
+    elif groups.get("raw"):
+        return groups["raw"]
+    else:
+        raise ValueError("Unknown match type.")
+
+
+# As process_html, but returns the expanded document as a list of chunks so
+# the top-level caller can stream them to disk without ever materializing
+# the full page as one string.
+def process_html_chunks(html: str, depth: int = 0) -> typing.List[str]:
+    # Fast path: no substitution markers at all, e.g. plain CSS or JS.
+    if OPEN not in html and not HTML_TAG_REGEX.search(html):
+        return [html]
+
+    if depth >= MAX_SUBSTITUTION_DEPTH:
+        raise ValueError("Maximum substitution depth exceeded.")
+
+    # Recurse directly into expansions that themselves contain markers
+    # instead of rescanning the whole document per round; each document is
+    # walked exactly once. Unmatched braces are left in place for
+    # process_page to warn about.
+    chunks = []
+    pos = 0
+    for m in SUBSTITUTION_REGEX.finditer(html):
+        if m.start() > pos:
+            chunks.append(html[pos : m.start()])
+
+        repl = handle_match(m, depth + 1)
+        if OPEN in repl or HTML_TAG_REGEX.search(repl):
+            chunks.extend(process_html_chunks(repl, depth + 1))
         else:
-            raise ValueError("Unknown match type.")
+            chunks.append(repl)
 
-        html = html.replace(m.group(0), repl)
-        m = re.search(regex, html)
-    return html
+        pos = m.end()
+    if pos < len(html):
+        chunks.append(html[pos:])
+    return chunks
+
+
+def process_html(html: str, depth: int = 0) -> str:
+    return "".join(process_html_chunks(html, depth))
 
 
 def process_page(page) -> None:
     output_dir = output_directory()
-    with open(os.path.join(PAGES_DIR, page), "r") as f:
-        html = f.read()
-
-    html = process_html(html)
-    if OPEN in html:
+    chunks = process_html_chunks(_read_text(os.path.join(PAGES_DIR, page)))
+    if any(OPEN in chunk for chunk in chunks):
         print(f"[WARN] Substitution may have failed for {page}.")
 
-    with open(os.path.join(output_dir, page), "w") as f:
-        f.write(html)
+    with open(os.path.join(output_dir, page), "wb") as f:
+        f.writelines(chunk.encode("utf-8") for chunk in chunks)
 
 
-PROCESSES = 12
-MULTIPROCESSING = False
+# Matches substitutions that may need to download an external resource.
+RESOURCE_REGEX = re.compile(
+    rf"(?P<func>bootstrap_icon|stylesheet|javascript)\(\s*(?P<arg>{FC}*)\s*\)"
+)
+
+# Matches icon substitutions whose name arrives through a kwarg, as in
+# {{ bootstrap_icon({{ ICON }}) }}, capturing the kwarg key.
+ICON_KWARG_REGEX = re.compile(
+    rf"bootstrap_icon\(\s*{OPEN}\s*(?P<key>[A-Z_]+)\s*{CLOSE}\s*\)"
+)
+
+# Bootstrap icon names are lowercase words joined by dashes.
+ICON_NAME_REGEX = re.compile(r"[a-z0-9-]+")
+
+# Downloads are latency-bound, not bandwidth-bound; a wide pool keeps a cold
+# build's worst case close to a single round trip.
+PREFETCH_THREADS = 32
+
+
+# Prefetching is best effort: report failures and move on, leaving the
+# resource to the render pass, which downloads it again and aborts the build
+# properly if it is truly needed.
+def _prefetch_resource(func: typing.Callable[[str], str], arg: str) -> None:
+    try:
+        func(arg)
+    except (Exception, SystemExit) as e:
+        print(f"[WARN] Failed to prefetch {arg}: {e}")
+
+
+# Warm the on-disk resource cache by downloading every icon and URL
+# referenced from the pages and includes concurrently, instead of paying one
+# network round trip at a time as the substitution pass encounters them.
+def prefetch_resources() -> None:
+    sources = []
+    with os.scandir(PAGES_DIR) as entries:
+        for entry in entries:
+            if entry.is_file():
+                sources.append(_read_text(entry.path))
+    for directory, _, files in os.walk(INCLUDE_DIR):
+        if directory.startswith(INCLUDE_CACHE_DIR):
+            continue
+        for file in files:
+            sources.append(_read_text(os.path.join(directory, file)))
+
+    # Most icons are referenced indirectly: an include expands
+    # bootstrap_icon({{ ICON }}) and its callers supply the name as a
+    # kwarg. Collect the kwarg keys that feed bootstrap_icon so literal
+    # values assigned to those keys can be warmed too; computed values are
+    # still downloaded lazily during rendering.
+    icon_kwargs = set()
+    for source in sources:
+        for m in ICON_KWARG_REGEX.finditer(source):
+            icon_kwargs.add(m.group("key"))
+
+    fetches = set()
+    for source in sources:
+        for m in RESOURCE_REGEX.finditer(source):
+            if m.group("func") == "bootstrap_icon":
+                fetches.add((bootstrap_icon, m.group("arg")))
+            elif is_url(m.group("arg")):
+                fetches.add((load_url, m.group("arg")))
+
+        # Only argument lists of actual substitution matches are scanned
+        # for icon kwargs; a bare k="v" in plain HTML, like a meta tag's
+        # name="viewport", is not an icon reference. Raw {{ ... }} block
+        # contents (ifdef bodies and the like) are scanned again, as they
+        # may hold further substitutions.
+        pending = [source]
+        while pending:
+            for m in SUBSTITUTION_REGEX.finditer(pending.pop()):
+                if m.group("raw"):
+                    pending.append(m.group("raw"))
+                    continue
+
+                args = m.group("args") or m.group("html_args")
+                if not args:
+                    continue
+                for arg in KWARG_ARG_REGEX.finditer(args):
+                    if arg.group("k").upper() in icon_kwargs:
+                        name = remove_quotes(arg.group("v"))
+                        if ICON_NAME_REGEX.fullmatch(name):
+                            fetches.add((bootstrap_icon, name))
+
+    if fetches:
+        with concurrent.futures.ThreadPoolExecutor(PREFETCH_THREADS) as pool:
+            futures = [
+                pool.submit(_prefetch_resource, func, arg)
+                for func, arg in fetches
+            ]
+            for future in futures:
+                future.result()
+
+
+# Populate the include cache in the parent process so forked workers inherit
+# every include copy-on-write instead of each re-reading them from disk. Both
+# spellings of .html includes are warmed, since includes may be referenced
+# with or without their extension.
+def warm_include_cache() -> None:
+    for directory, _, files in os.walk(INCLUDE_DIR):
+        if directory.startswith(INCLUDE_CACHE_DIR):
+            continue
+        for file in files:
+            relative = os.path.relpath(
+                os.path.join(directory, file), INCLUDE_DIR
+            )
+            _read_include(relative)
+            if relative.endswith(".html"):
+                _read_include(relative[: -len(".html")])
+
+
+# Forked workers must not share the parent's live HTTP connections: two
+# processes checking the same inherited socket out of a pool can interleave
+# requests and corrupt downloads written to the persistent cache. Called in
+# the parent immediately before forking, and again in each worker via the
+# pool initializer, so every process starts with fresh, unopened clients.
+def _reset_http_clients() -> None:
+    global HTTP, HTTP2
+    HTTP.clear()
+    HTTP = urllib3.PoolManager()
+    if HTTP2 is not None:
+        HTTP2.close()
+        HTTP2 = httpx.Client(http2=True, follow_redirects=True)
+
+
+PROCESSES = os.cpu_count() or 4
+
+# Pages are independent of one another, and the worker pool is forked after
+# the resource prefetch, so workers inherit the warmed caches copy-on-write
+# rather than each re-downloading and re-reading everything.
+MULTIPROCESSING = True
 
 
 def main() -> None:
+    prefetch_resources()
+
+    # scandir's DirEntry caches the file type, avoiding a stat per page, and
+    # lets non-page files be filtered out up front.
+    with os.scandir(PAGES_DIR) as entries:
+        pages = [
+            entry.name
+            for entry in entries
+            if entry.is_file() and entry.name.endswith(".html")
+        ]
+
     if MULTIPROCESSING:
-        with multiprocessing.Pool(PROCESSES) as pool:
-            pool.map(process_page, os.listdir(PAGES_DIR))
+        warm_include_cache()
+        _reset_http_clients()
+        # ProcessPoolExecutor rather than multiprocessing.Pool: template
+        # errors abort via exit(), and the executor marshals the worker's
+        # SystemExit back to this process (multiprocessing.Pool only
+        # catches Exception, losing the task and hanging the build).
+        # Results are discarded; consuming them surfaces worker failures.
+        chunksize = max(1, len(pages) // (PROCESSES * 4))
+        with concurrent.futures.ProcessPoolExecutor(
+            PROCESSES, initializer=_reset_http_clients
+        ) as pool:
+            for _ in pool.map(process_page, pages, chunksize=chunksize):
+                pass
     else:
-        for page in os.listdir(PAGES_DIR):
-            process_page(page)
+        # Single-process fallback; still overlap page reads, rehosted asset
+        # downloads and output writes with threads.
+        with concurrent.futures.ThreadPoolExecutor() as pool:
+            for _ in pool.map(process_page, pages):
+                pass
 
 
 if __name__ == "__main__":
@@ -33,6 +33,13 @@ class Test(unittest.TestCase):
         build.process_preamble(html, kwargs)
         self.assertEqual(kwargs["VAR"], "val")
 
+    def test_preamble_helpers(self) -> None:
+        # Preambles in the includes call module helpers like unique_string.
+        kwargs: typing.Dict[str, str] = {}
+        html = "PREAMBLE {{\nkwargs['ID'] = unique_string()\n}}"
+        build.process_preamble(html, kwargs)
+        self.assertRegex(kwargs["ID"], r"^[A-Z][A-Z0-9]{7}$")
+
     def test_strip_comments(self) -> None:
         html = """
             <!-- HTML comment -->